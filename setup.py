@@ -8,9 +8,8 @@ setup(
     description='A random collection of useful scripts',
     license='apache2',
     install_requires = [
-      'jinja2',
       'absl-py',
-      'beautifulsoup4',
+      'lxml',
     ],
     scripts = [
       'table2markdown/table2markdown.py'
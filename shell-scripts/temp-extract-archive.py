@@ -4,15 +4,17 @@
 from __future__ import print_function
 
 import collections
+import concurrent.futures
+import errno
 try:
   from absl import flags
 except ImportError:
   import warnings
   warnings.warn('Using the deprecated gflags module. Please install absl-py', DeprecationWarning)
   import gflags as flags
-import itertools
 import logging
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -32,6 +34,9 @@ flags.DEFINE_bool('extractor_output', False,
 flags.DEFINE_bool('pretend_case_insensitive', True,
     'Should we recursively walk the output of the archive and merge '
     'directories that only differ by case.')
+flags.DEFINE_integer('max_parallel', None,
+    'The maximum number of archives to extract at once. Defaults to the '
+    'number of CPUs.', lower_bound=1)
 
 FLAGS = flags.FLAGS
 
@@ -44,80 +49,175 @@ class MergeFailureError(Exception):
   pass
 
 
+class ExtractionFailedError(Exception):
+  pass
+
+
+# Maps file extensions to the name of the Extractor method to use.
+_ZIP_EXTENSIONS = ('.cbz', '.egg', '.jar', '.par', '.zip', '.apk', '.xapk', '.crx')
+_EXTRACTOR_TABLE_7Z = {
+    **dict.fromkeys(('.cbr', '.rar', '.rar_'), '_extract_rar'),
+    **dict.fromkeys(_ZIP_EXTENSIONS, '_extract_7z'),
+    **dict.fromkeys(('.7z', '.img', '.iso', '.dmg'), '_extract_7z'),
+    **dict.fromkeys(
+        ('.bz2', '.gz2', '.tgz', '.tbz', '.tar', '.gz', '.xz', '.zst'),
+        '_extract_tar'),
+    **dict.fromkeys(('.deb', ), '_extract_ar'),
+}
+_EXTRACTOR_TABLE_UNZIP = {
+    **_EXTRACTOR_TABLE_7Z,
+    **dict.fromkeys(_ZIP_EXTENSIONS, '_extract_zip'),
+}
+
+
 class Extractor(object):
   def __init__(self, tempdir, locale_override):
     self.tempdir = tempdir
     self.locale_override = locale_override
-    self._extractors = self.create_extractors_mapping()
-
-  def create_extractors_mapping(self):
-    ret = {}
-    for ext in {'.cbr', '.rar', '.rar_'}:
-      ret[ext] = self._extract_rar
-    for ext in {'.cbz', '.egg', '.jar', '.par', '.zip', '.apk', '.xapk', '.crx'}:
-      if FLAGS.use_7z_for_zip:
-        ret[ext] = self._extract_7z
-      else:
-        ret[ext] = self._extract_zip
-    for ext in {'.7z', '.img', '.iso', '.dmg'}:
-      ret[ext] = self._extract_7z
-    for ext in {'.bz2', '.gz2', '.tgz', '.tbz', '.tar', '.gz', '.xz', '.zst'}:
-      ret[ext] = self._extract_tar
-    for ext in {'.deb', }:
-      ret[ext] = self._extract_ar
-    return ret
+    # The environment for the extractors. None means inherit ours as-is.
+    if locale_override:
+      self._env = dict(os.environ, LC_ALL=locale_override)
+    else:
+      self._env = None
+    if FLAGS.use_7z_for_zip:
+      self._extractors = _EXTRACTOR_TABLE_7Z
+    else:
+      self._extractors = _EXTRACTOR_TABLE_UNZIP
+    # Maps a directory to the contents of its passwd.txt (if any).
+    self._passwd_cache = {}
+
+  def _read_password_file(self, filename):
+    # Password files are tiny, so skip the exists() check and the buffered
+    # file object, and just try to read it.
+    try:
+      fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+      return None
+    try:
+      return os.read(fd, 4096).decode().strip()
+    finally:
+      os.close(fd)
 
   def _get_password(self, container_filename):
+    password = self._read_password_file(
+        '{}.password'.format(container_filename))
+    if password is not None:
+      return password
+
+    # Archives tend to come in groups, so only look for a passwd.txt once per
+    # directory.
     dirname = os.path.dirname(container_filename)
-    filenames_to_test = [
-        '{}.password'.format(container_filename),
-        os.path.join(dirname, 'passwd.txt'),
-    ]
-    for filename in filenames_to_test:
-      if os.path.exists(filename):
-        with open(filename) as f:
-          return f.read().strip()
-
-  def extract_archive(self, filename):
+    if dirname not in self._passwd_cache:
+      self._passwd_cache[dirname] = self._read_password_file(
+          os.path.join(dirname, 'passwd.txt'))
+    return self._passwd_cache[dirname]
+
+  def _get_extractor_func(self, filename):
+    _, filename_extension = os.path.splitext(filename)
+    if FLAGS.override_extension:
+      filename_extension = FLAGS.override_extension
+    filename_extension = filename_extension.lower()
+
+    extractor_name = self._extractors.get(filename_extension)
+    if extractor_name is None:
+      raise UnknownArchiveError(
+          'Attempting to extract unknown archive extension: {}'.format(
+              filename_extension))
+    return getattr(self, extractor_name)
+
+  def is_thread_safe(self, filename):
+    """Can the given archive be extracted alongside other archives?
+
+    unrar is not happy running multiple copies at once, so rar archives get
+    extracted one at a time.
+    """
+    return self._get_extractor_func(filename) != self._extract_rar
+
+  def can_batch(self, filename, output_dir):
+    """Can the given archive share an extractor process with other archives?
+
+    Only 7z can extract several archives in one go. We hand it the archives in
+    a UTF-8 listfile and use -o* so that each one is extracted into a
+    directory named after the archive without its extension. Each line of the
+    listfile is a wildcard, where only '*' and '?' are special ('@' and '-'
+    only mean something on the commandline), and surrounding whitespace is
+    not significant. Anything that doesn't fit (or whose output_dir is not
+    the directory 7z would pick) is extracted on its own.
+    """
+    stem, extension = os.path.splitext(os.path.basename(filename))
+    try:
+      filename.encode('utf-8')
+    except UnicodeEncodeError:
+      return False
+    return (
+        self._get_extractor_func(filename) == self._extract_7z
+        and bool(stem) and bool(extension)
+        and os.path.basename(output_dir) == stem
+        and not any(c in filename for c in '*?\r\n')
+        and filename == filename.strip())
+
+  def extract_archive(self, filename, output_dir=None):
     """Attempt to extract the archive into the given temp dir.
 
     Args:
       filename: The archive to extract. This must be a full path (as the 
         extractor will not be running in our cwd.
+      output_dir: The directory to extract into. Defaults to the temp dir.
 
     Raises:
       UnknownArchiveError: If we don't know how to extract the given extension.
     """
-    _, filename_extension = os.path.splitext(filename)
-    if FLAGS.override_extension:
-      filename_extension = FLAGS.override_extension
-    filename_extension = filename_extension.lower()
+    extractor_func = self._get_extractor_func(filename)
+    return extractor_func(filename, output_dir or self.tempdir)
 
-    extractor_func = self._extractors.get(filename_extension)
-    if extractor_func is None:
-      raise UnknownArchiveError(
-          'Attempting to extract unknown archive extension: {}'.format(
-              filename_extension))
-    return extractor_func(filename)
-
-  def _run_extractor(self, cmd):
-    env = dict(os.environ)
-    if self.locale_override:
-      env['LC_ALL'] = self.locale_override
-    with open('/dev/null', 'r+') as dev_null:
-      extractor = subprocess.Popen(
-          cmd,
-          env=env,
-          cwd=self.tempdir,
-          stdin=dev_null,
-          stderr=subprocess.STDOUT,
-          stdout=None if FLAGS.extractor_output else dev_null,
-      )
-    return extractor.wait()
+  def extract_archives(self, archives):
+    """Attempt to extract several archives, each into its own directory.
+
+    Archives that 7z can deal with share a single 7z process per password,
+    everything else is extracted one archive at a time.
+
+    Args:
+      archives: (filename, output_dir) pairs. The filenames must be full paths.
+
+    Returns:
+      The archives whose extractor exited with an error.
+
+    Raises:
+      UnknownArchiveError: If we don't know how to extract the given extension.
+    """
+    failed = []
+    batches = collections.defaultdict(list)
+    for filename, output_dir in archives:
+      if self.can_batch(filename, output_dir):
+        key = (self._get_password(filename), os.path.dirname(output_dir))
+        batches[key].append((filename, output_dir))
+      elif self.extract_archive(filename, output_dir) != 0:
+        failed.append(filename)
+    for (password, parent_dir), batch in batches.items():
+      if len(batch) == 1:
+        if self.extract_archive(*batch[0]) != 0:
+          failed.append(batch[0][0])
+      else:
+        filenames = [filename for filename, _ in batch]
+        # 7z doesn't tell us which archive failed, so blame them all.
+        if self._run_7z_batch(filenames, password, parent_dir) != 0:
+          failed += filenames
+    return failed
+
+  def _run_extractor(self, cmd, output_dir):
+    return subprocess.run(
+        cmd,
+        env=self._env,
+        cwd=output_dir,
+        stdin=subprocess.DEVNULL,
+        stderr=subprocess.STDOUT,
+        stdout=None if FLAGS.extractor_output else subprocess.DEVNULL,
+        check=False,
+    ).returncode
 
   # Extractors for different container types.
 
-  def _extract_rar(self, filename):
+  def _extract_rar(self, filename, output_dir):
     password = self._get_password(filename)
     cmdline = ['unrar', 'x']
     cmdline += ['-or']  # Rename files with the same name.
@@ -126,129 +226,239 @@ class Extractor(object):
     else:
       cmdline.append('-p{}'.format(password))
     cmdline += ['--', filename]
-    return self._run_extractor(cmdline)
+    return self._run_extractor(cmdline, output_dir)
 
-  def _extract_zip(self, filename):
+  def _extract_zip(self, filename, output_dir):
     password = self._get_password(filename)
     cmdline = ['unzip']
     if password is not None:
       cmdline.append('-p{}'.format(password))
     cmdline += ['--', filename]
-    return self._run_extractor(cmdline)
+    return self._run_extractor(cmdline, output_dir)
   
-  def _extract_7z(self, filename):
+  def _extract_7z(self, filename, output_dir):
     password = self._get_password(filename)
     cmdline = ['7z', 'x', '-y']
     if password is not None:
       cmdline.append('-p{}'.format(password))
     cmdline += ['--', filename]
-    return self._run_extractor(cmdline)
-
-  def _extract_tar(self, filename):
+    return self._run_extractor(cmdline, output_dir)
+
+  def _run_7z_batch(self, filenames, password, parent_dir):
+    """Extract each archive into parent_dir/<archive name minus extension>."""
+    # Any extra filenames on the commandline are treated as files to extract
+    # from the first archive, so pass the archives in a listfile instead.
+    with tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', suffix='.lst') as listfile:
+      listfile.writelines('{}\n'.format(filename) for filename in filenames)
+      listfile.flush()
+      cmdline = ['7z', 'x', '-y', '-scsUTF-8', '-o*']
+      if password is not None:
+        cmdline.append('-p{}'.format(password))
+      cmdline += ['-an', '-ai@{}'.format(listfile.name)]
+      return self._run_extractor(cmdline, parent_dir)
+
+  def _extract_tar(self, filename, output_dir):
     cmdline = ['tar', 'xvvf']
     cmdline.append(filename)
-    return self._run_extractor(cmdline)
+    return self._run_extractor(cmdline, output_dir)
 
-  def _extract_ar(self, filename):
+  def _extract_ar(self, filename, output_dir):
     cmdline = ['ar', 'x']
     cmdline += ['--', filename]
-    return self._run_extractor(cmdline)
+    return self._run_extractor(cmdline, output_dir)
 
 
 def _listdirs(dirname):
-  for entry in os.listdir(dirname):
-    yield entry, os.path.isdir(os.path.join(dirname, entry))
+  with os.scandir(dirname) as it:
+    for entry in it:
+      yield entry.name, entry.is_dir(follow_symlinks=False)
+
+
+def _move(src, dst):
+  try:
+    os.rename(src, dst)
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+    # src and dst are on different filesystems, so we need to copy.
+    shutil.move(src, dst)
 
 
 def _merge_files_in_directories(remote_dir, local_dir):
   assert remote_dir != local_dir, (
       'Merge files called with both directories equal: %r' % remote_dir)
   logger = logging.getLogger('MergeEntriesInDirectories')
-  logger.debug('Merging "%s" and "%s"', remote_dir, local_dir)
-
-  local_dir_entries = {entry: is_dir for entry,is_dir in _listdirs(local_dir)}
-  for entry, is_dir in _listdirs(remote_dir):
-    if entry in local_dir_entries:
-      if not is_dir and not local_dir_entries[entry]:
-        # TODO: Verify that entry is the same file in both.
-        logger.info('Skipping "%s" as it exists in both directories', entry)
-        os.unlink(os.path.join(remote_dir, entry))
-        continue
-      if not is_dir or not local_dir_entries[entry]:
-        # Trying to merge a directory and a file... just bail
-        raise MergeFailureError(
-            'Failed to merge the directories "%s" and "%s"' % (
-              os.path.join(local_dir, entry),
-              os.path.join(remote_dir, entry),
-            )
-        )
 
-      _merge_files_in_directories(
-        os.path.join(remote_dir, entry),
-        os.path.join(local_dir, entry),
-      )
-    else:
-      os.rename(
+  work = collections.deque([(remote_dir, local_dir)])
+  # Directories are only empty once all of their children have been merged, so
+  # remove them in the reverse order that we visited them.
+  merged_dirs = []
+  while work:
+    remote_dir, local_dir = work.popleft()
+    logger.debug('Merging "%s" and "%s"', remote_dir, local_dir)
+
+    local_dir_entries = {entry: is_dir for entry,is_dir in _listdirs(local_dir)}
+    for entry, is_dir in _listdirs(remote_dir):
+      if entry in local_dir_entries:
+        if not is_dir and not local_dir_entries[entry]:
+          # TODO: Verify that entry is the same file in both.
+          logger.info('Skipping "%s" as it exists in both directories', entry)
+          os.unlink(os.path.join(remote_dir, entry))
+          continue
+        if not is_dir or not local_dir_entries[entry]:
+          # Trying to merge a directory and a file... just bail
+          raise MergeFailureError(
+              'Failed to merge the directories "%s" and "%s"' % (
+                os.path.join(local_dir, entry),
+                os.path.join(remote_dir, entry),
+              )
+          )
+
+        work.append((
           os.path.join(remote_dir, entry),
-          s.path.join(local_dir, entry),
-      )
-  os.rmdir(remote_dir)
+          os.path.join(local_dir, entry),
+        ))
+      else:
+        _move(
+            os.path.join(remote_dir, entry),
+            os.path.join(local_dir, entry),
+        )
+    merged_dirs.append(remote_dir)
+
+  for remote_dir in reversed(merged_dirs):
+    os.rmdir(remote_dir)
 
 
 def _merge_directories_ignore_case(base_dir):
   logger = logging.getLogger('MergeDirectories')
-  dirs = [
-      entry for entry in os.listdir(base_dir)
-      if os.path.isdir(os.path.join(base_dir, entry))]
-
-  # Merge things that differ by case.
-  dir_map = collections.defaultdict(set)
-  for dir_ in dirs:
-    dir_map[dir_.lower()].add(dir_)
-
-  for k, dirs in dir_map.items():
-    if len(dirs) <= 1:
-      continue
-
-    # Pick a random dir to be come our base (preferable one that is not all
-    # lowercase).
-    local_dir = (dirs - {k}).pop()
-
-    dirs.remove(local_dir)
-    for remote_dir in dirs:
-      _merge_files_in_directories(
-          os.path.join(base_dir, remote_dir),
-          os.path.join(base_dir, local_dir),
-      )
-    dir_map[k] = {local_dir}
+  work = collections.deque([base_dir])
+  while work:
+    base_dir = work.popleft()
+
+    # Merge things that differ by case.
+    dir_map = {}
+    for entry, is_dir in _listdirs(base_dir):
+      if is_dir:
+        dir_map.setdefault(entry.casefold(), []).append(entry)
+
+    for k, dirs in dir_map.items():
+      if len(dirs) == 1:
+        local_dir, = dirs
+      else:
+        # Pick a dir to become our base (preferably one that is not all
+        # lowercase).
+        local_dir = next((dir_ for dir_ in dirs if dir_ != k), dirs[0])
 
-  for dir_ in itertools.chain.from_iterable(dir_map.values()):
-    _merge_directories_ignore_case(
-        os.path.join(base_dir, dir_))
+        for remote_dir in dirs:
+          if remote_dir == local_dir:
+            continue
+          _merge_files_in_directories(
+              os.path.join(base_dir, remote_dir),
+              os.path.join(base_dir, local_dir),
+          )
+      work.append(os.path.join(base_dir, local_dir))
 
 
 def _get_minimal_common_directory(base_dir):
   logger = logging.getLogger('MinimalCommonDir')
-  last_dir = base_dir
-  for dirpath, dirnames, filenames in os.walk(base_dir):
-    last_dir = dirpath
+  dirpath = base_dir
+  while True:
+    dirnames = []
+    filenames = []
+    for entry, is_dir in _listdirs(dirpath):
+      (dirnames if is_dir else filenames).append(entry)
     logger.info('Got, dirpath=%r, dirnames=%r, filenames=%r',
         dirpath, dirnames, filenames)
-    if filenames:
-      return last_dir
-    if len(dirnames) != 1:
-      return last_dir
-  return last_dir
+    if filenames or len(dirnames) != 1:
+      return dirpath
+    dirpath = os.path.join(dirpath, dirnames[0])
+
+
+def _get_output_dirs(filenames, tempdir):
+  """Create a directory for each archive, named after the archive."""
+  output_dirs = {}
+  # Directories that only differ by case get merged later on (see
+  # --pretend_case_insensitive), so they need to be unique ignoring case.
+  used_names = set()
+  for filename in filenames:
+    basename = os.path.basename(filename)
+    stem = os.path.splitext(basename)[0] or basename
+    name = stem
+    suffix = 1
+    while name.casefold() in used_names:
+      suffix += 1
+      name = '{}.{}'.format(stem, suffix)
+    used_names.add(name.casefold())
+    output_dirs[filename] = os.path.join(tempdir, name)
+    os.mkdir(output_dirs[filename])
+  return output_dirs
+
+
+def _extract_archives(extractor, filenames, tempdir):
+  # Extracting the same archive twice at once would only trip over itself.
+  filenames = list(dict.fromkeys(filenames))
+  # Give each archive its own directory, so that files from different archives
+  # can't collide, and concurrent extractors don't trip over each other.
+  output_dirs = _get_output_dirs(filenames, tempdir)
+
+  def extract(filenames):
+    failed = extractor.extract_archives(
+        [(filename, output_dirs[filename]) for filename in filenames])
+    if failed:
+      raise ExtractionFailedError(
+          'The extractor exited with an error for: {}'.format(
+              ', '.join(failed)))
+
+  parallel_tasks = []
+  serial_tasks = []
+  batchable_filenames = []
+  for filename in filenames:
+    if not extractor.is_thread_safe(filename):
+      serial_tasks.append([filename])
+    elif extractor.can_batch(filename, output_dirs[filename]):
+      batchable_filenames.append(filename)
+    else:
+      parallel_tasks.append([filename])
+
+  max_workers = FLAGS.max_parallel or os.cpu_count() or 1
+  if len(batchable_filenames) > max_workers:
+    # More archives than workers, so share extractor processes between them.
+    # This doesn't change where anything ends up.
+    parallel_tasks += [
+        batchable_filenames[i::max_workers] for i in range(max_workers)]
+  else:
+    parallel_tasks += [[filename] for filename in batchable_filenames]
+
+  # Run everything to completion, so a failure in one archive doesn't hide
+  # failures in the others.
+  errors = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+    futures = {pool.submit(extract, task): task for task in parallel_tasks}
+    for task in serial_tasks:
+      try:
+        extract(task)
+      except Exception as e:
+        errors.append((task, e))
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        future.result()
+      except Exception as e:
+        errors.append((futures[future], e))
+
+  if errors:
+    # The first error is raised, so only log the rest.
+    for task, e in errors[1:]:
+      logging.error('Failed to extract %s: %s', ', '.join(task), e)
+    raise errors[0][1]
 
 
 def main(filenames, tempdir):
   # Get the fully qualified path name for the input file
-  filenames = [
-      os.path.join(os.getcwd(), filename) for filename in filenames]
+  filenames = [os.path.abspath(filename) for filename in filenames]
 
   extractor = Extractor(tempdir, locale_override=FLAGS.decode_locale)
-  for filename in filenames:
-    extractor.extract_archive(filename)
+  _extract_archives(extractor, filenames, tempdir)
 
   if FLAGS.decode_charset:
     subprocess.Popen([
@@ -282,13 +492,7 @@ def munge_directories(tmp_dir):
 
 
 def removedirs(basedir):
-  for dirpath, dirnames, filenames in os.walk(basedir, topdown=False):
-    for dirname in dirnames:
-      os.rmdir(os.path.join(dirpath, dirname))
-
-    for filename in filenames:
-      os.unlink(os.path.join(dirpath, filename))
-  os.rmdir(basedir)
+  shutil.rmtree(basedir)
 
 
 def _get_tmpdir():
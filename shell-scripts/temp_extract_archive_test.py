@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+from absl.testing import absltest
+from absl.testing import flagsaver
+import importlib.util
+import os
+
+_spec = importlib.util.spec_from_file_location(
+    'temp_extract_archive',
+    os.path.join(os.path.dirname(__file__), 'temp-extract-archive.py'))
+temp_extract_archive = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(temp_extract_archive)
+
+
+class FakeExtractor(temp_extract_archive.Extractor):
+  """Records the extractor commandlines instead of running them."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.calls = []
+
+  def _run_extractor(self, cmd, output_dir):
+    listfiles = [arg[len('-ai@'):] for arg in cmd if arg.startswith('-ai@')]
+    archives = []
+    for listfile in listfiles:
+      with open(listfile, encoding='utf-8') as f:
+        archives += f.read().splitlines()
+    self.calls.append((cmd, output_dir, archives))
+    return 0
+
+
+class SevenZipTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.archive_dir = self.create_tempdir().full_path
+    self.tempdir = self.create_tempdir().full_path
+
+  def _archive(self, name):
+    return os.path.join(self.archive_dir, name)
+
+  def test_single_archive(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    output_dir = os.path.join(self.tempdir, 'a')
+    extractor.extract_archives([(self._archive('a.zip'), output_dir)])
+    self.assertEqual(extractor.calls, [
+        (['7z', 'x', '-y', '--', self._archive('a.zip')], output_dir, []),
+    ])
+
+  def test_batch(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    extractor.extract_archives([
+        (self._archive('a.zip'), os.path.join(self.tempdir, 'a')),
+        (self._archive('b.7z'), os.path.join(self.tempdir, 'b')),
+    ])
+    self.assertLen(extractor.calls, 1)
+    cmd, cwd, archives = extractor.calls[0]
+    self.assertEqual(cmd[:-1], ['7z', 'x', '-y', '-scsUTF-8', '-o*', '-an'])
+    self.assertStartsWith(cmd[-1], '-ai@')
+    self.assertEqual(cwd, self.tempdir)
+    self.assertEqual(archives, [self._archive('a.zip'), self._archive('b.7z')])
+
+  def test_batch_with_password(self):
+    with open(self._archive('passwd.txt'), 'w') as f:
+      f.write('hunter2\n')
+    extractor = FakeExtractor(self.tempdir, None)
+    extractor.extract_archives([
+        (self._archive('a.zip'), os.path.join(self.tempdir, 'a')),
+        (self._archive('b.zip'), os.path.join(self.tempdir, 'b')),
+    ])
+    self.assertLen(extractor.calls, 1)
+    self.assertIn('-phunter2', extractor.calls[0][0])
+
+  def test_unbatchable_names(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    extractor.extract_archives([
+        (self._archive('a*.zip'), os.path.join(self.tempdir, 'a*')),
+        # 7z would extract this into 'b', not 'b.2'.
+        (self._archive('b.zip'), os.path.join(self.tempdir, 'b.2')),
+    ])
+    self.assertEqual(
+        [(cmd[-1], cwd) for cmd, cwd, _ in extractor.calls],
+        [
+            (self._archive('a*.zip'), os.path.join(self.tempdir, 'a*')),
+            (self._archive('b.zip'), os.path.join(self.tempdir, 'b.2')),
+        ])
+
+  @flagsaver.flagsaver(max_parallel=4)
+  def test_no_batching_with_spare_workers(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    filenames = [self._archive(name) for name in ('a.zip', 'b.zip', 'c.zip')]
+    temp_extract_archive._extract_archives(extractor, filenames, self.tempdir)
+    self.assertCountEqual(
+        [(cmd[-1], cwd) for cmd, cwd, _ in extractor.calls],
+        [
+            (self._archive('a.zip'), os.path.join(self.tempdir, 'a')),
+            (self._archive('b.zip'), os.path.join(self.tempdir, 'b')),
+            (self._archive('c.zip'), os.path.join(self.tempdir, 'c')),
+        ])
+
+  @flagsaver.flagsaver(max_parallel=1)
+  def test_batching_with_more_archives_than_workers(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    filenames = [self._archive(name) for name in ('a.zip', 'b.zip', 'c.zip')]
+    temp_extract_archive._extract_archives(extractor, filenames, self.tempdir)
+    self.assertLen(extractor.calls, 1)
+    _, cwd, archives = extractor.calls[0]
+    self.assertEqual(cwd, self.tempdir)
+    self.assertEqual(archives, filenames)
+    self.assertCountEqual(os.listdir(self.tempdir), ['a', 'b', 'c'])
+
+
+class FailureTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.archive_dir = self.create_tempdir().full_path
+    self.tempdir = self.create_tempdir().full_path
+
+  @flagsaver.flagsaver(max_parallel=2, use_7z_for_zip=False)
+  def test_non_zero_exit_is_an_error(self):
+    extractor = FakeExtractor(self.tempdir, None)
+    extractor._run_extractor = lambda cmd, output_dir: (
+        1 if cmd[-1].endswith('bad.zip') else 0)
+    filenames = [
+        os.path.join(self.archive_dir, name) for name in ('good.zip', 'bad.zip')]
+    with self.assertRaisesRegex(
+        temp_extract_archive.ExtractionFailedError, 'bad.zip'):
+      temp_extract_archive._extract_archives(
+          extractor, filenames, self.tempdir)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -4,14 +4,21 @@ from absl import app
 from absl import flags
 from absl import logging
 from typing import List
+import codecs
+import collections
 import enum
-import bs4
 import dataclasses
-import jinja2
+import itertools
+import lxml.etree
+import re
 import sys
 
 
 flags.DEFINE_string('input_filename', '/dev/stdin', 'The name of the document to parse')
+flags.DEFINE_string('input_encoding', None,
+                    'The encoding of the document, if it does not declare one. '
+                    'Defaults to UTF-8, or windows-1252 if the document is not '
+                    'valid UTF-8.')
 flags.DEFINE_bool('pretty_print', True, 'The name of the document to parse')
 FLAGS = flags.FLAGS
 
@@ -28,25 +35,118 @@ class Table:
   rows: List[List[str]]
   max_col_lengths: List[int]
   alignments: List[Alignment]
+  right_align: List[bool]
 
 
-def parse_doc(soup):
+# How far into the document to look for an encoding declaration (the same
+# limit browsers use).
+_SNIFF_SIZE = 1024
+_READ_SIZE = 64 * 1024
+_BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+_DECLARED_ENCODING_RE = re.compile(
+    rb'<meta[^>]*charset|<\?xml[^>]*encoding', re.IGNORECASE)
+
+
+def _declares_encoding(prefix):
+  return (
+      prefix.startswith(_BOMS)
+      or _DECLARED_ENCODING_RE.search(prefix) is not None)
+
+
+def _guess_encoding(prefix):
+  """Guess the encoding of an undeclared document, the same way browsers do."""
+  try:
+    # Don't count a multi-byte sequence cut off at the end of prefix.
+    codecs.getincrementaldecoder('utf-8')().decode(prefix)
+  except UnicodeDecodeError:
+    return 'cp1252'
+  return 'utf-8'
+
+
+def iter_tables(fp, default_encoding=None):
+  """Yield each <table> element in the document as soon as it is parsed.
+
+  Tables are cleared (along with anything parsed before them) once the caller
+  is done with them, so we never hold the whole document in memory.
+
+  libxml2 does not guess encodings, so unless the document declares one (with
+  a BOM or a <meta charset>) it is decoded as default_encoding. If that is
+  None, we use UTF-8 if the start of the document is valid UTF-8, and
+  windows-1252 otherwise.
+  """
+  chunk = fp.read(_READ_SIZE)
+  if _declares_encoding(chunk[:_SNIFF_SIZE]):
+    encoding = None
+  else:
+    # libxml2 doesn't know all of Python's aliases (e.g. latin-1), but it does
+    # know the canonical names.
+    encoding = codecs.lookup(
+        default_encoding or _guess_encoding(chunk)).name.replace('_', '-')
+  parser = lxml.etree.HTMLPullParser(
+      events=('end',), tag='table', encoding=encoding)
+  while chunk:
+    parser.feed(chunk)
+    yield from _read_tables(parser)
+    chunk = fp.read(_READ_SIZE)
+  parser.close()
+  yield from _read_tables(parser)
+
+
+def _read_tables(parser):
+  for _, table in parser.read_events():
+    if next(table.iterancestors('table'), None) is not None:
+      # Nested tables are handled (in document order) with their outer table.
+      continue
+    yield from table.iter('table')
+    table.clear()
+    while table.getprevious() is not None:
+      del table.getparent()[0]
+
+
+# Whitespace inside a cell that would otherwise break the markdown row.
+_WHITESPACE_TO_SPACE = str.maketrans('\t\n\r\f\v', '     ')
+
+
+def _get_text(elem):
+  text = ' '.join(filter(None, map(str.strip, elem.itertext())))
+  return text.translate(_WHITESPACE_TO_SPACE)
+
+
+# The largest colspan the HTML spec allows.
+_MAX_COLSPAN = 1000
+_LEADING_DIGITS_RE = re.compile(r'\s*(\d+)')
+
+
+def _get_colspan(td):
+  # Real pages have things like colspan="2;" or colspan="100%", so (like
+  # browsers) we only look at the leading digits.
+  match = _LEADING_DIGITS_RE.match(td.attrib.get('colspan', ''))
+  if match is None:
+    return 1
+  return min(max(int(match.group(1)), 1), _MAX_COLSPAN)
+
+
+def parse_doc(tables):
   column_headers = []
   rows = []
   # The internet is horrid... We iterate over all tables, and just stitch them into on.
-  for table in soup.find_all('table'):
-    if (thead := table.find('thead', recursive=False)) is not None:
-      for tr in thead.find_all('tr', recursive=False):
-        for elem in tr.find_all(['td', 'th'], recursive=False):
-          column_headers.append(' '.join(elem.stripped_strings))
-    for tbody in table.find_all('tbody', recursive=False):
-      for tr in tbody.find_all('tr', recursive=False):
-        values = []
-        for td in tr.find_all('td', recursive=False):
-          values.append(' '.join(td.stripped_strings))
-          if 'colspan' in td.attrs:
-            colspan = int(td.attrs['colspan'])
-            values.extend(['']*colspan - 1)
+  for table in tables:
+    if (thead := table.find('thead')) is not None:
+      for tr in thead.iterchildren('tr'):
+        for elem in tr.iterchildren('td', 'th'):
+          column_headers.append(_get_text(elem))
+    for tbody in table.iterchildren('tbody'):
+      for tr in tbody.iterchildren('tr'):
+        # Size the row up front when we know how many columns to expect, and
+        # only grow it for rows that are wider than the headers.
+        values = [''] * len(column_headers)
+        col = 0
+        for td in tr.iterchildren('td'):
+          colspan = _get_colspan(td)
+          if col + colspan > len(values):
+            values.extend([''] * (col + colspan - len(values)))
+          values[col] = _get_text(td)
+          col += colspan
         if any(values):
           # Only add non-empty rows into the template
           rows.append(values)
@@ -54,75 +154,72 @@ def parse_doc(soup):
     column_headers = rows[0]
     rows = rows[1:]
 
-  # Check for un-equal length rows
+  # Work out the number of columns, how wide each column is (to allow us to
+  # format the markdown nicely) and guess the default alignment, all in a
+  # single pass over the rows.
   columns = len(column_headers)
+  max_lengths = collections.defaultdict(lambda: 3)  # Treat 0 length columns as 3 characters.
+  alignments = collections.defaultdict(lambda: Alignment.RIGHT)
   for row in rows:
-    columns = max(columns, len(row))
-  # Extend short rows to be of equal length
-  if len(column_headers) < columns:
-      column_headers.extend(['()[]'] * (columns - len(column_headers)))
-  for row in rows:
-    if len(row) < columns:
-      row.extend([''] * (columns - len(row)))
-
-  # Determine how wide each column is (to allow us to format the markdown nicely)
-  max_lengths = [3] * columns  # Treat 0 length columns as 3 characters.
-  for i, col in enumerate(column_headers):
-    max_lengths[i] = max(max_lengths[i], len(col))
-  for row in rows:
-    for i, col in enumerate(row):
-      max_lengths[i] = max(max_lengths[i], len(col))
-
-  # Guess default alignment for data
-  alignments = [Alignment.RIGHT] * columns
-  for row in rows:
+    row_len = len(row)
+    if row_len > columns:
+      columns = row_len
     for i, col in enumerate(row):
+      col_len = len(col)
+      if col_len > max_lengths[i]:
+        max_lengths[i] = col_len
       if col and not col.isdigit():
         alignments[i] = Alignment.LEFT
 
+  # Extend short headers to cover every column. Short rows are padded when the
+  # markdown is generated.
+  if len(column_headers) < columns:
+      column_headers.extend(['()[]'] * (columns - len(column_headers)))
+
+  max_lengths = [
+      max(max_lengths[i], len(col)) for i, col in enumerate(column_headers)]
+  alignments = [alignments[i] for i in range(columns)]
+
   return Table(
       column_headers=column_headers,
       rows=rows,
       max_col_lengths=max_lengths,
       alignments=alignments,
+      right_align=[alignment == Alignment.RIGHT for alignment in alignments],
   )
 
 
-_MARKDOWN_TEMPLATE_PRETTY = jinja2.Template('''\
-{% for col in column_headers %}{% if not loop.first %} | {% endif %}{{ col.center(max_lengths[loop.index0]) }}{% endfor %}
-{% for col in column_headers %}{% if not loop.first %} | {% endif %}{{ '-' * max_lengths[loop.index0] }}{% endfor %}
-{% for row in rows %}\
-{% for value in row %}{% if not loop.first %} | {% endif %}{% if right_align[loop.index0] %}{{ value.rjust(max_lengths[loop.index0]) }}{% else %}{{ value.ljust(max_lengths[loop.index0]) }}{% endif %}{% endfor %}
-{% endfor %}
-''')
-_MARKDOWN_TEMPLATE = jinja2.Template('''\
-{% for col in column_headers %}{% if not loop.first %} | {% endif %}{{ col }}{% endfor %}
-{% for col in column_headers %}{% if not loop.first %} | {% endif %}{{ '-' * 3 }}{% endfor %}
-{% for row in rows %}\
-{% for value in row %}{% if not loop.first %} | {% endif %}{{ value }}{% endfor %}
-{% endfor %}
-''')
-def generate_markdown(table):
-  if FLAGS.pretty_print:
-    template = _MARKDOWN_TEMPLATE_PRETTY
+def generate_markdown(table, pretty_print):
+  columns = len(table.column_headers)
+  lines = []
+  if pretty_print:
+    widths = table.max_col_lengths
+    aligners = [
+        str.rjust if right_align else str.ljust
+        for right_align in table.right_align]
+    lines.append(' | '.join(
+        col.center(width) for col, width in zip(table.column_headers, widths)))
+    lines.append(' | '.join('-' * width for width in widths))
+    for row in table.rows:
+      # Short rows are padded out with empty cells.
+      lines.append(' | '.join(
+          align(value, width) for align, value, width in
+          itertools.zip_longest(aligners, row, widths, fillvalue='')))
   else:
-    template = _MARKDOWN_TEMPLATE
-  return template.render(
-      column_headers=table.column_headers,
-      rows=table.rows,
-      max_lengths=table.max_col_lengths,
-      right_align=[alignment == Alignment.RIGHT for alignment in table.alignments],
-  )
+    lines.append(' | '.join(table.column_headers))
+    lines.append(' | '.join(['-' * 3] * columns))
+    for row in table.rows:
+      lines.append(' | '.join(
+          itertools.chain(row, [''] * (columns - len(row)))))
+  return '\n'.join(lines) + '\n'
 
 
 def main(argv):
-  # Parse the document passed on stdin
+  # Parse the document passed on stdin, one table at a time.
   with open(FLAGS.input_filename, 'rb') as fp:
-    soup = bs4.BeautifulSoup(fp, 'html.parser')
-  assert soup is not None
-
-  table = parse_doc(soup)
-  sys.stdout.write(generate_markdown(table))
+    table = parse_doc(
+        iter_tables(fp, default_encoding=FLAGS.input_encoding))
+  sys.stdout.write(generate_markdown(table, pretty_print=FLAGS.pretty_print))
 
 if __name__ == '__main__':
   app.run(main)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from absl.testing import absltest
+import io
+
+import table2markdown
+
+
+def _markdown(document, **kwargs):
+  table = table2markdown.parse_doc(
+      table2markdown.iter_tables(io.BytesIO(document), **kwargs))
+  return table2markdown.generate_markdown(table, pretty_print=True)
+
+
+class EncodingTest(absltest.TestCase):
+
+  def test_undeclared_utf8(self):
+    document = (
+        '<table><tbody><tr><td>Fruit</td></tr><tr><td>Apple café</td></tr>'
+        '</tbody></table>').encode('utf-8')
+    self.assertEqual(
+        _markdown(document),
+        '  Fruit   \n'
+        '----------\n'
+        'Apple café\n')
+
+  def test_undeclared_cp1252(self):
+    document = (
+        '<table><tbody><tr><td>Fruit</td></tr><tr><td>Apple café</td></tr>'
+        '<tr><td>“Pear”</td></tr></tbody></table>').encode('cp1252')
+    self.assertEqual(
+        _markdown(document),
+        '  Fruit   \n'
+        '----------\n'
+        'Apple café\n'
+        '“Pear”    \n')
+
+  def test_undeclared_utf8_cut_off_by_sniffing(self):
+    # The sniffed prefix ends half way through the 'é'.
+    start = b'<table><tbody><tr><td>'
+    padding = b'x' * (table2markdown._READ_SIZE - len(start) - 1)
+    document = start + padding + 'é</td></tr></tbody></table>'.encode('utf-8')
+    self.assertIn('xé', _markdown(document))
+
+  def test_undeclared_default_encoding(self):
+    document = (
+        '<table><tbody><tr><td>Fruit</td></tr><tr><td>Apple café</td></tr>'
+        '</tbody></table>').encode('latin-1')
+    self.assertIn(
+        'Apple café', _markdown(document, default_encoding='latin-1'))
+
+  def test_declared_charset(self):
+    document = (
+        '<html><head><meta charset="shift_jis"></head><body><table><tbody>'
+        '<tr><td>日本</td></tr><tr><td>東京</td></tr></tbody></table>'
+        '</body></html>').encode('shift_jis')
+    self.assertIn('東京', _markdown(document))
+
+
+class CellTextTest(absltest.TestCase):
+
+  def test_multiline_cell_stays_on_one_row(self):
+    document = (
+        b'<table><tbody><tr><td>Name</td><td>n</td></tr>'
+        b'<tr><td>multi\nline <b>cell</b></td><td>1</td></tr>'
+        b'</tbody></table>')
+    self.assertEqual(
+        _markdown(document),
+        '      Name      |  n \n'
+        '--------------- | ---\n'
+        'multi line cell |   1\n')
+
+
+class ColspanTest(absltest.TestCase):
+
+  def test_colspan(self):
+    document = (
+        b'<table><thead><tr><th>A</th><th>B</th><th>C</th></tr></thead><tbody>'
+        b'<tr><td colspan="2">wide</td><td>3</td></tr>'
+        b'<tr><td colspan="2;">x</td><td>y</td></tr>'
+        b'<tr><td colspan="">1</td><td colspan="0">2</td></tr>'
+        b'</tbody></table>')
+    table = table2markdown.parse_doc(
+        table2markdown.iter_tables(io.BytesIO(document)))
+    self.assertEqual(table.column_headers, ['A', 'B', 'C'])
+    self.assertEqual(table.rows, [
+        ['wide', '', '3'],
+        ['x', '', 'y'],
+        ['1', '2', ''],
+    ])
+
+  def test_percentage_colspan_uses_leading_digits(self):
+    document = (
+        b'<table><tbody><tr><td>A</td></tr>'
+        b'<tr><td colspan="100%">x</td></tr></tbody></table>')
+    table = table2markdown.parse_doc(
+        table2markdown.iter_tables(io.BytesIO(document)))
+    self.assertLen(table.rows[0], 100)
+
+  def test_huge_colspan_is_clamped(self):
+    document = (
+        b'<table><tbody><tr><td>A</td></tr>'
+        b'<tr><td colspan="100000">x</td></tr></tbody></table>')
+    table = table2markdown.parse_doc(
+        table2markdown.iter_tables(io.BytesIO(document)))
+    self.assertLen(table.rows[0], 1000)
+
+
+if __name__ == '__main__':
+  absltest.main()